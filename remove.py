@@ -1,10 +1,16 @@
-import requests
-from requests.auth import HTTPBasicAuth
-from datetime import datetime
+import argparse
+import asyncio
+import hashlib
+import httpx
+import orjson
+from dataclasses import dataclass, field, fields
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
 import inquirer
-import pytz
 from dotenv import load_dotenv
 import os
+import sys
+import time
 
 # Load environment variables
 load_dotenv()
@@ -13,117 +19,356 @@ CLIENT_ID = os.getenv('CLIENT_ID')
 CLIENT_SECRET = os.getenv('CLIENT_SECRET')
 REFRESH_TOKEN = os.getenv('REFRESH_TOKEN')
 
-def get_access_token(client_id, client_secret, refresh_token):
+def get_account_key(client_id, refresh_token):
+    return hashlib.sha256(f"{client_id}:{refresh_token}".encode()).hexdigest()  # Identifies the account in caches without storing its credentials
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.spotify_episodes_remover')
+
+def write_private_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as f: # Readable by the owner only
+        f.write(data)
+
+MAX_RETRIES = 5 # Attempts per request before giving up on a rate-limited call
+
+def get_retry_delay(response, attempt):
+    try:
+        return float(response.headers['Retry-After'])
+    except (KeyError, ValueError):
+        return 2 ** attempt # Header missing or given as an HTTP date
+
+async def send_request(client, method, url, reauthorize=True, **kwargs):
+    for attempt in range(MAX_RETRIES):
+        response = await client.request(method, url, **kwargs)
+        if response.status_code == 401 and reauthorize:
+            # The access token was revoked or expired early: replace it once and retry
+            reauthorize = False
+            if await reauthorize_client(client, response.request.headers.get('Authorization')):
+                continue
+            return response
+        if response.status_code != 429 or attempt == MAX_RETRIES - 1:
+            return response # Not rate limited, or out of retries
+        # Rate limited: wait as long as Spotify asks, or back off exponentially if it doesn't say
+        delay = get_retry_delay(response, attempt)
+        print(f"Rate limited by Spotify, retrying in {delay:g}s...")
+        await asyncio.sleep(delay)
+    return response
+
+async def get_access_token(client, client_id, client_secret, refresh_token):
     url = "https://accounts.spotify.com/api/token"
     data = {
         'grant_type': 'refresh_token',
         'refresh_token': refresh_token
     }
-    auth = HTTPBasicAuth(client_id, client_secret)  # Basic auth for Spotify API
-    response = requests.post(url, data=data, auth=auth)
+    auth = (client_id, client_secret)  # Basic auth for Spotify API
+    response = await send_request(client, 'POST', url, reauthorize=False, data=data, auth=auth)
     if response.status_code == 200:
         print("Successfully obtained access token.")
-        return response.json()['access_token']  # Return the new access token
+        return orjson.loads(response.content)  # Return the token response, including access_token and expires_in
     else:
         print(f"Failed to get access token. Status code: {response.status_code}")
         print(f"Response: {response.text}")
         return None
 
-def get_saved_episodes(access_token):
-    url = "https://api.spotify.com/v1/me/episodes"
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-    }
-    episodes = []
-    while url:
-        response = requests.get(url, headers=headers)
-        if response.status_code == 200:
-            data = response.json()
-            episodes.extend(data['items'])  # Append fetched episodes to our list
-            url = data['next']
-        else:
-            print(f"Failed to fetch saved episodes. Status code: {response.status_code}")
-            print(f"Response: {response.text}")
-            break
+TOKEN_CACHE_PATH = os.path.join(CACHE_DIR, 'token.json')
+TOKEN_EXPIRY_MARGIN = 60 # Don't hand out a token that is about to expire
+
+# Credentials for one Spotify account, where its token is cached, and the lock that serializes its token refreshes
+@dataclass
+class SpotifyAccount:
+    client_id: str
+    client_secret: str
+    refresh_token: str
+    token_cache_path: str = TOKEN_CACHE_PATH
+    refresh_lock: asyncio.Lock = field(default_factory=asyncio.Lock, repr=False)  # Create the account inside the running event loop
+
+    @property
+    def key(self):
+        return get_account_key(self.client_id, self.refresh_token)
+
+async def get_cached_access_token(client, account, use_cache=True):
+    path = account.token_cache_path
+    if use_cache:
+        try:
+            with open(path, 'rb') as f:
+                cached = orjson.loads(f.read())
+            if cached['account'] == account.key and cached['expires_at'] > time.time() + TOKEN_EXPIRY_MARGIN:
+                print("Using cached access token.")
+                return cached['token']
+        except (OSError, ValueError, KeyError):
+            pass # No usable cached token, request a new one
+
+    requested_at = time.time()
+    token = await get_access_token(client, account.client_id, account.client_secret, account.refresh_token)
+    if token is None:
+        return None
+    try:
+        write_private_file(path, orjson.dumps({'account': account.key, 'token': token['access_token'], 'expires_at': requested_at + token['expires_in']}))
+    except OSError as e:
+        print(f"Warning: could not cache access token at {path}: {e}") # The token is still valid for this run
+    return token['access_token']
+
+def invalidate_token_cache(path=TOKEN_CACHE_PATH):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+async def reauthorize_client(client, rejected_authorization):
+    account = getattr(client, 'spotify_account', None)
+    if account is None:
+        return False # Not authorized through authorize_client, so there is nothing to refresh with
+    async with account.refresh_lock: # Requests rejected at the same time replace the token only once
+        if client.headers.get('Authorization') != rejected_authorization:
+            return True # Another request already replaced the token
+        print("Access token was rejected, requesting a new one.")
+        invalidate_token_cache(account.token_cache_path)
+        access_token = await get_cached_access_token(client, account, use_cache=False)
+        if access_token is None:
+            return False
+        authorize_client(client, access_token, account)
+        return True
+
+def authorize_client(client, access_token, account):
+    client.headers.update({'Authorization': f'Bearer {access_token}'})  # Sent with every subsequent API call
+    client.spotify_account = account  # Lets a rejected request refresh the token for the same account
+
+SAVED_EPISODES_URL = "https://api.spotify.com/v1/me/episodes"
+PAGE_LIMIT = 50  # Largest page size the saved-episodes endpoint allows
+
+async def fetch_saved_episodes_page(client, offset, limit=PAGE_LIMIT):
+    params = {'offset': offset, 'limit': limit}
+    response = await send_request(client, 'GET', SAVED_EPISODES_URL, params=params)
+    if response.status_code == 200:
+        return orjson.loads(response.content)
+    print(f"Failed to fetch saved episodes at offset {offset}. Status code: {response.status_code}")
+    print(f"Response: {response.text}")
+    return None
+
+DATE_SEPARATORS = str.maketrans('', '', '-T:Z')  # Strips '2024-01-31T12:00:00Z' down to its digits
+
+# Both encoders return None for dates they can't read; such episodes never match a date filter
+def encode_added_at(added_at):
+    try:
+        return int(added_at.translate(DATE_SEPARATORS))  # YYYYMMDDHHMMSS in UTC
+    except (AttributeError, ValueError):
+        return None
+
+def encode_release_date(release_date):
+    digits = release_date.replace('-', '') if isinstance(release_date, str) else ''
+    if len(digits) not in (4, 6, 8) or not digits.isdigit():
+        return None # Not a YYYY, YYYY-MM or YYYY-MM-DD date
+    return int(digits.ljust(8, '9'))  # YYYYMMDD; year/month precision dates sort last in their period, so they only match once the whole period is before the cutoff
+
+def decode_added_at(added_at):
+    date, clock = divmod(added_at, 1000000)
+    return datetime(date // 10000, date // 100 % 100, date % 100,
+                    clock // 10000, clock // 100 % 100, clock % 100, tzinfo=timezone.utc)
+
+def decode_release_date(release_date):
+    digits = str(release_date)
+    return '-'.join(part for part in (digits[:4], digits[4:6], digits[6:]) if part != '99')  # Drop padding added for year/month precision
+
+# Saved episodes stored as one list per field, holding only what filtering, display and removal need
+@dataclass
+class EpisodeTable:
+    ids: list = field(default_factory=list)
+    names: list = field(default_factory=list)
+    show_names: list = field(default_factory=list)
+    publishers: list = field(default_factory=list)
+    added_at: list = field(default_factory=list)  # encode_added_at values
+    release_dates: list = field(default_factory=list)  # encode_release_date values
+
+    def __len__(self):
+        return len(self.ids)
+
+    def append(self, item):
+        episode = item['episode']
+        show = episode['show']
+        self.ids.append(episode['id'])
+        self.names.append(episode['name'])
+        self.show_names.append(show['name'])
+        self.publishers.append(show['publisher'])
+        self.added_at.append(encode_added_at(item['added_at']))
+        self.release_dates.append(encode_release_date(episode['release_date']))
+
+    def take(self, indices):
+        return EpisodeTable(**{f.name: [getattr(self, f.name)[i] for i in indices] for f in fields(self)})
+
+async def get_saved_episodes_async(client, max_concurrency=10):
+    semaphore = asyncio.Semaphore(max_concurrency)  # Bound in-flight requests to respect Spotify rate limits
+
+    async def fetch_page(offset):
+        async with semaphore:
+            return await fetch_saved_episodes_page(client, offset)
+
+    # The first page tells us the total, so every remaining page can be requested at once
+    episodes = EpisodeTable()
+    first_page = await fetch_saved_episodes_page(client, 0)
+    if first_page is None:
+        return episodes, None
+    limit, total = first_page['limit'], first_page['total']
+    offsets = range(limit, total, limit)
+    pages = [first_page] + await asyncio.gather(*[fetch_page(offset) for offset in offsets])
+
+    for page in pages:
+        if page is not None:
+            for item in page['items']:
+                episodes.append(item)  # Extract every field in one pass, in offset order
     print(f"Total episodes fetched: {len(episodes)}")
+    if len(episodes) < total:
+        print(f"Warning: {total - len(episodes)} of {total} saved episodes could not be fetched, results will be incomplete.")
+    return episodes, total
+
+EPISODES_CACHE_PATH = os.path.join(CACHE_DIR, 'episodes.json')
+EPISODES_CACHE_MAX_AGE = timedelta(hours=1)
+
+def load_cached_episodes(account_key, path=EPISODES_CACHE_PATH):
+    try:
+        with open(path, 'rb') as f:
+            cache = orjson.loads(f.read())
+        if cache['account'] != account_key:
+            return None, None # Cached for a different account
+        return EpisodeTable(**cache['episodes']), datetime.fromisoformat(cache['fetched_at'])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None, None # No usable cache
+
+def save_cached_episodes(episodes, account_key, path=EPISODES_CACHE_PATH):
+    cache = orjson.dumps({'account': account_key, 'fetched_at': datetime.now(timezone.utc).isoformat(), 'episodes': episodes}) # orjson serializes the dataclass directly
+    try:
+        write_private_file(path, cache)
+    except OSError as e:
+        print(f"Warning: could not cache saved episodes at {path}: {e}") # The cache is only an optimization, carry on without it
+
+def invalidate_episodes_cache(path=EPISODES_CACHE_PATH):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+async def get_saved_episodes_total(client):
+    page = await fetch_saved_episodes_page(client, 0, limit=1) # Cheapest request that still reports the library size
+    return page['total'] if page is not None else None
+
+async def get_saved_episodes_cached(client, account_key, use_cache=True):
+    if use_cache:
+        episodes, fetched_at = load_cached_episodes(account_key)
+        if episodes is not None:
+            if datetime.now(timezone.utc) - fetched_at < EPISODES_CACHE_MAX_AGE:
+                print(f"Using {len(episodes)} episodes cached at {fetched_at:%Y-%m-%d %H:%M:%S %Z}.")
+                return episodes
+            # Older cache: trust it as long as the library size hasn't changed
+            if await get_saved_episodes_total(client) == len(episodes):
+                print(f"Library unchanged since {fetched_at:%Y-%m-%d %H:%M:%S %Z}, using {len(episodes)} cached episodes.")
+                return episodes
+
+    episodes, total = await get_saved_episodes_async(client)
+    if episodes and len(episodes) == total:
+        save_cached_episodes(episodes, account_key) # Never cache a library with missing pages
     return episodes
 
 def get_unique_authors(episodes):
-    authors = set()
-    for ep in episodes:
-        authors.add(ep['episode']['show']['publisher'])  # Add each unique publisher to a set
-    return sorted(authors)
-
-def remove_saved_episode(access_token, episode_id):
-    url = f"https://api.spotify.com/v1/me/episodes?ids={episode_id}"
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-    }
-    response = requests.delete(url, headers=headers)
+    return sorted(set(episodes.publishers))
+
+MAX_IDS_PER_REQUEST = 50  # Spotify accepts up to 50 comma-separated ids per call
+
+async def remove_saved_episodes_batch(client, episode_ids):
+    url = f"{SAVED_EPISODES_URL}?ids={','.join(episode_ids)}"
+    response = await send_request(client, 'DELETE', url)
     return response.status_code
 
-def remove_episodes_by_date(episodes, date_type, before_date, local_tz, selected_authors=None):
+async def remove_saved_episodes(client, episode_ids, max_concurrency=10):
+    semaphore = asyncio.Semaphore(max_concurrency)  # Bound in-flight requests to respect Spotify rate limits
+    chunks = [episode_ids[i:i + MAX_IDS_PER_REQUEST] for i in range(0, len(episode_ids), MAX_IDS_PER_REQUEST)]
+
+    async def remove_chunk(chunk):
+        async with semaphore:
+            return await remove_saved_episodes_batch(client, chunk)
+
+    chunk_statuses = await asyncio.gather(*[remove_chunk(chunk) for chunk in chunks])
+
+    # Map each chunk's status back onto its episodes, preserving the input order
+    return [status for chunk, status in zip(chunks, chunk_statuses) for _ in chunk]
+
+def remove_episodes_by_date(episodes, date_type, before_date, local_tz, selected_authors=None, verbose=False):
     before_date_obj = datetime.strptime(before_date, '%Y-%m-%d')
-    before_date_obj = local_tz.localize(before_date_obj) # Convert the before_date to a timezone-aware datetime
-    filtered_episodes = []
+    before_date_obj = before_date_obj.replace(tzinfo=local_tz) # Convert the before_date to a timezone-aware datetime
 
     if not selected_authors:
         print("No authors selected, please select at least one author.")
-        return filtered_episodes
-
-    for ep in episodes:
-        episode_title = ep['episode']['name']
-        podcast_name = ep['episode']['show']['name']
-        podcast_author = ep['episode']['show']['publisher']
-
-        if podcast_author not in selected_authors:
-            continue # Skip episodes that don't match the selected authors
-
-        # Determine the date type for filtering
-        if date_type == 'Date Added to Library':
-            episode_date = datetime.strptime(ep['added_at'], '%Y-%m-%dT%H:%M:%SZ')
-            date_label = "Date Added to Library"
-        elif date_type == 'Podcast Release Date':
-            episode_date = datetime.strptime(ep['episode']['release_date'], '%Y-%m-%d')
-            date_label = "Podcast Release Date"
-        
-        # Convert episode date to the local timezone
-        episode_date = pytz.utc.localize(episode_date).astimezone(local_tz)
-        
-        if episode_date < before_date_obj:
-            filtered_episodes.append(ep)
-            print(f"Test mode: Would remove episode '{episode_title}' from podcast '{podcast_name}' by '{podcast_author}' ({date_label}: {episode_date.strftime('%Y-%m-%d %H:%M:%S %Z')})")
-
-    print(f"Total episodes matching criteria: {len(filtered_episodes)}")
+        return EpisodeTable()
+    selected_authors = frozenset(selected_authors) # Constant-time author lookups inside the loop
+
+    # Determine the date type for filtering, encoding the cutoff once so each episode is a plain integer comparison
+    if date_type == 'Date Added to Library':
+        episode_dates = episodes.added_at
+        before_date_int = int(before_date_obj.astimezone(timezone.utc).strftime('%Y%m%d%H%M%S'))
+        date_label = "Date Added to Library"
+    elif date_type == 'Podcast Release Date':
+        episode_dates = episodes.release_dates
+        before_date_int = int(before_date_obj.strftime('%Y%m%d')) # Release dates are calendar dates, so no timezone applies
+        date_label = "Podcast Release Date"
+    else:
+        print(f"Unknown date type: {date_type}")
+        return EpisodeTable()
+
+    matches = [i for i, (episode_date, podcast_author) in enumerate(zip(episode_dates, episodes.publishers))
+               if episode_date is not None and episode_date < before_date_int and podcast_author in selected_authors]
+    filtered_episodes = episodes.take(matches)
+
+    # Format the matches only when they'll be shown, and write them out in one go
+    log_lines = []
+    if verbose:
+        for episode_title, podcast_name, podcast_author, added_at, release_date in zip(
+                filtered_episodes.names, filtered_episodes.show_names, filtered_episodes.publishers,
+                filtered_episodes.added_at, filtered_episodes.release_dates):
+            if date_type == 'Date Added to Library':
+                episode_date = decode_added_at(added_at).astimezone(local_tz).strftime('%Y-%m-%d %H:%M:%S %Z') # Convert to the local timezone only for display
+            else:
+                episode_date = decode_release_date(release_date)
+            log_lines.append(f"Test mode: Would remove episode '{episode_title}' from podcast '{podcast_name}' by '{podcast_author}' ({date_label}: {episode_date})")
+
+    log_lines.append(f"Total episodes matching criteria: {len(filtered_episodes)}")
+    sys.stdout.write("\n".join(log_lines) + "\n")
     return filtered_episodes
 
 # Main function to run the episode removal process based on user input
-def remove_episodes_based_on_filter(test_mode=True, date_type='Date Added to Library', before_date=None, local_tz=pytz.utc, selected_authors=None):
-    access_token = get_access_token(CLIENT_ID, CLIENT_SECRET, REFRESH_TOKEN)
+async def remove_episodes_based_on_filter(client, test_mode=True, date_type='Date Added to Library', before_date=None, local_tz=timezone.utc, selected_authors=None, access_token=None, episodes=None, use_cache=True, account=None):
+    if account is None:
+        account = SpotifyAccount(CLIENT_ID, CLIENT_SECRET, REFRESH_TOKEN)
+
+    # Only authenticate and fetch when the caller hasn't already done so
     if access_token is None:
-        print("Exiting script due to failure in obtaining access token.")
-        return
+        access_token = await get_cached_access_token(client, account, use_cache)
+        if access_token is None:
+            print("Exiting script due to failure in obtaining access token.")
+            return
+        authorize_client(client, access_token, account)
     
-    episodes = get_saved_episodes(access_token)
+    if episodes is None:
+        episodes = await get_saved_episodes_cached(client, account.key, use_cache)
     if not episodes:
         print("No episodes were returned.")
         return
 
+    episodes_to_remove = EpisodeTable()
     if before_date:
-        episodes_to_remove = remove_episodes_by_date(episodes, date_type, before_date, local_tz, selected_authors)
+        episodes_to_remove = remove_episodes_by_date(episodes, date_type, before_date, local_tz, selected_authors, verbose=test_mode) # Outside test mode each removal is reported below
 
     # If not in test mode, actually remove the episodes
     if not test_mode and episodes_to_remove:
-        for episode in episodes_to_remove:
-            episode_id = episode['episode']['id']
-            status = remove_saved_episode(access_token, episode_id)
+        statuses = await remove_saved_episodes(client, episodes_to_remove.ids)
+        invalidate_episodes_cache() # The cached library no longer matches Spotify
+        log_lines = []
+        for episode_title, podcast_name, status in zip(episodes_to_remove.names, episodes_to_remove.show_names, statuses):
             if status == 200:
-                print(f"Removed episode '{episode['episode']['name']}' from podcast '{episode['episode']['show']['name']}'")
+                log_lines.append(f"Removed episode '{episode_title}' from podcast '{podcast_name}'")
             else:
-                print(f"Failed to remove episode '{episode['episode']['name']}' from podcast '{episode['episode']['show']['name']}'")
+                log_lines.append(f"Failed to remove episode '{episode_title}' from podcast '{podcast_name}'")
+        sys.stdout.write("\n".join(log_lines) + "\n")
 
-# Entry point of the script, handling user input and invoking the main process
-if __name__ == "__main__":
+# Interactive flow, sharing one HTTP client (and its connection) for the whole run
+async def main(client, account, use_cache=True):
     common_timezones = [
         ("UTC (Coordinated Universal Time)", "UTC"),
         ("America/New_York (EST, UTC-5)", "America/New_York"),
@@ -137,30 +382,24 @@ if __name__ == "__main__":
     ]
 
     # Initial setup to fetch episodes and extract authors
-    access_token = get_access_token(CLIENT_ID, CLIENT_SECRET, REFRESH_TOKEN)
-
-    if access_token:
-        # Get unique authors from saved episodes
-        episodes = get_saved_episodes(access_token)
-        authors = get_unique_authors(episodes)
-        authors.insert(0, "Select All")
-        selected_authors = inquirer.prompt([inquirer.Checkbox(
-            'authors',
-            message="Select author(s) to filter episodes by (use spacebar to select, enter to confirm):",
-            choices=authors,
-        )])['authors']
-        
-        # Automatically select all if the user didn't select anything
-        if not selected_authors or "Select All" in selected_authors:
-            selected_authors = authors[1:]
-            print("Automatically selecting all authors as none were explicitly selected.")
+    access_token = await get_cached_access_token(client, account, use_cache)
 
-    else:
+    if not access_token:
         print("Failed to authenticate with Spotify.")
-        exit()
+        return
+
+    authorize_client(client, access_token, account)
+    # Get unique authors from saved episodes
+    episodes = await get_saved_episodes_cached(client, account.key, use_cache)
+    authors = get_unique_authors(episodes)
+    authors.insert(0, "Select All")
 
-    # Asking the user for more specific filtering options
+    # Asking the user for all filtering options in a single form, now that every choice is known
     questions = [
+        inquirer.Checkbox('authors',
+                          message="Select author(s) to filter episodes by (use spacebar to select, enter to confirm):",
+                          choices=authors,
+                          ),
         inquirer.List('date_type',
                       message="Choose the date type for filtering episodes",
                       choices=['Date Added to Library', 'Podcast Release Date'],
@@ -178,8 +417,28 @@ if __name__ == "__main__":
 
     # Capture the user's responses
     answers = inquirer.prompt(questions)
-    local_tz = pytz.timezone(dict(common_timezones)[answers['timezone']])
+    selected_authors = answers['authors']
+
+    # Automatically select all if the user didn't select anything
+    if not selected_authors or "Select All" in selected_authors:
+        selected_authors = authors[1:]
+        print("Automatically selecting all authors as none were explicitly selected.")
+
+    local_tz = ZoneInfo(dict(common_timezones)[answers['timezone']])
 
     # Running the filtering/removal process based on user input
     print(f"Running with the following options: Date Type = {answers['date_type']}, Before Date = {answers['before_date']}, Test Mode = {answers['test_mode']}, Timezone = {answers['timezone']}, Authors = {selected_authors}")
-    remove_episodes_based_on_filter(test_mode=answers['test_mode'], date_type=answers['date_type'], before_date=answers['before_date'], local_tz=local_tz, selected_authors=selected_authors)
\ No newline at end of file
+    await remove_episodes_based_on_filter(client, test_mode=answers['test_mode'], date_type=answers['date_type'], before_date=answers['before_date'], local_tz=local_tz, selected_authors=selected_authors, access_token=access_token, episodes=episodes, use_cache=use_cache, account=account)
+
+async def run(use_cache=True):
+    # HTTP/2 lets the concurrent page fetches and deletions share one multiplexed connection
+    async with httpx.AsyncClient(http2=True) as client:
+        account = SpotifyAccount(CLIENT_ID, CLIENT_SECRET, REFRESH_TOKEN)  # Read the credentials once, inside the event loop
+        await main(client, account, use_cache)
+
+# Entry point of the script, handling user input and invoking the main process
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Remove saved Spotify episodes matching a date and author filter.")
+    parser.add_argument('--no-cache', action='store_true', help="ignore the cached access token and episode library and fetch them again")
+    args = parser.parse_args()
+    asyncio.run(run(use_cache=not args.no_cache))